@@ -10,12 +10,9 @@
 import imp
 import os
 import platform
-from   PyInstaller.utils.hooks import copy_metadata
 import sys
 
-# I don't know why, but on Windows, the binary can't find humanize at run
-# time even if I put it in hiddenimports.  Adding it here solved it.
-data_files = copy_metadata('uritools')
+data_files = []
 
 configuration = Analysis([r'urlup\__main__.py'],
                          pathex = ['.'],
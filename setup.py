@@ -47,5 +47,5 @@ setup(
     scripts          = ['bin/urlup'],
     install_requires = reqs,
     platforms        = 'any',
-    python_requires  = '>=3',
+    python_requires  = '>=3.7',
 )
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    test_scheduling.py
+# @brief   Tests of how lookups are scheduled, using local HTTP servers
+# @author  Michael Hucka <mhucka@caltech.edu>
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/caltechlibrary/urlup
+#
+# Run with "python3 -m unittest discover -s tests" from the project directory.
+# =============================================================================
+
+from   concurrent.futures import CancelledError, ThreadPoolExecutor
+from   http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import socket
+import sys
+from   threading import Lock, Thread
+from   time import monotonic, sleep
+import unittest
+from   unittest import mock
+
+# Allow this program to be executed directly from the 'tests' directory.
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import urlup.urlup as uu
+from urlup.proxy_helper import ProxyHelper
+
+
+# Test servers.
+# .............................................................................
+# Each server is a different host as far as urlup is concerned.  Host names
+# end in ".test" (a domain reserved for testing), and are resolved to the
+# loopback address by _resolve() instead of DNS.
+
+class _Handler(BaseHTTPRequestHandler):
+    '''Answers requests according to the first part of the path:
+         /ok/...       200
+         /slow/...     200 after half a second
+         /429/...      429 without a Retry-After header
+         /once429/...  429 with "Retry-After: 1" the first time, then 200
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        server = self.server
+        with server.lock:
+            server.arrivals.append((self.path, monotonic()))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            first_time = server.paths.get(self.path, 0) == 0
+            server.paths[self.path] = server.paths.get(self.path, 0) + 1
+        try:
+            kind = self.path.split('/')[1]
+            if kind == 'slow':
+                sleep(0.5)
+            if kind == '429' or (kind == 'once429' and first_time):
+                self.send_response(429)
+                if kind == 'once429':
+                    self.send_header('Retry-After', '1')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class _Server(ThreadingHTTPServer):
+    def __init__(self, name):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.host = '{}:{}'.format(name, self.server_address[1])
+        self.lock = Lock()
+        self.reset()
+        Thread(target = self.serve_forever, daemon = True).start()
+
+    def reset(self):
+        with self.lock:
+            self.arrivals = []          # (path, time) of each request.
+            self.paths = {}             # Number of requests for each path.
+            self.active = 0
+            self.max_active = 0
+
+    def url(self, path):
+        return 'http://' + self.host + path
+
+    def times(self, path):
+        with self.lock:
+            return [when for (p, when) in self.arrivals if p == path]
+
+
+_getaddrinfo = socket.getaddrinfo
+
+def _resolve(host, port, *args, **kwargs):
+    if host.endswith('.test'):
+        host = '127.0.0.1'
+    return _getaddrinfo(host, port, *args, **kwargs)
+
+
+def _wait_for(condition):
+    give_up = monotonic() + 5
+    while not condition():
+        if monotonic() > give_up:
+            raise AssertionError('Gave up waiting')
+        sleep(0.01)
+
+
+# Tests.
+# .............................................................................
+
+class SchedulingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.resolver = mock.patch.object(uu, '_real_getaddrinfo', _resolve)
+        cls.resolver.start()
+        cls.servers = [_Server('host{}.urlup.test'.format(n)) for n in range(2)]
+
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.shutdown()
+            server.server_close()
+        cls.resolver.stop()
+
+
+    def setUp(self):
+        for server in self.servers:
+            server.reset()
+
+
+    def requests_made(self):
+        return sum(len(server.arrivals) for server in self.servers)
+
+
+    def dispatcher(self, workers):
+        '''Return a _Dispatcher doing real lookups with 'workers' threads.'''
+        executor = ThreadPoolExecutor(max_workers = workers)
+        helper = ProxyHelper(None, None, False, False)
+        session = uu.http_session()
+        def attempt(job, unreachable):
+            return uu._attempt(job, {}, {}, helper, session, True, False, False)
+        dispatcher = uu._Dispatcher(executor, attempt)
+        dns = uu._dns_caching()
+        dns.__enter__()
+        self.addCleanup(dns.__exit__, None, None, None)
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(dispatcher.close)
+        return dispatcher
+
+
+    def submit(self, dispatcher, server, path):
+        url = server.url(path)
+        return dispatcher.submit(url, uu.normalized_url(url), server.host)
+
+
+    def test_per_host_limit(self):
+        urls = [server.url('/slow/{}'.format(n))
+                for server in self.servers for n in range(10)]
+        results = uu.updated_urls(urls, concurrency = 16)
+        self.assertEqual({r.status for r in results}, {200})
+        for server in self.servers:
+            self.assertEqual(server.max_active, uu._MAX_PER_HOST)
+
+
+    def test_retry_after(self):
+        # With only 2 workers, lookups on the second host can only finish
+        # while those on the first wait if waiting doesn't take a worker.
+        slow, fast = self.servers
+        start = monotonic()
+        results = uu.updated_urls([slow.url('/once429/{}'.format(n)) for n in range(4)]
+                                  + [fast.url('/ok/{}'.format(n)) for n in range(8)],
+                                  concurrency = 2)
+        self.assertEqual({r.status for r in results}, {200})
+        for n in range(4):
+            first, second = slow.times('/once429/{}'.format(n))
+            self.assertGreaterEqual(second - first, 0.95)
+        self.assertLess(max(when for (_, when) in fast.arrivals) - start, 0.9)
+
+
+    def test_pacing_backoff_and_recovery(self):
+        server = self.servers[0]
+        dispatcher = self.dispatcher(4)
+        paths = ['/429/1', '/429/2', '/ok/1', '/ok/2']
+        intervals = []
+        for path in paths:
+            self.assertEqual(self.submit(dispatcher, server, path).result(5).status,
+                             429 if '429' in path else 200)
+            intervals.append(dispatcher._hosts[server.host].interval)
+        step = uu._PACE_STEP
+        self.assertEqual(intervals, [step, 2 * step, step, 0])
+        starts = [server.times(path)[0] for path in paths]
+        self.assertGreaterEqual(starts[1] - starts[0], step - 0.02)
+        self.assertGreaterEqual(starts[2] - starts[1], 2 * step - 0.02)
+
+
+    def test_pacing_burst_counts_once(self):
+        server = self.servers[0]
+        dispatcher = self.dispatcher(uu._MAX_PER_HOST)
+        futures = [self.submit(dispatcher, server, '/429/{}'.format(n))
+                   for n in range(uu._MAX_PER_HOST)]
+        self.assertEqual({f.result(5).status for f in futures}, {429})
+        self.assertEqual(dispatcher._hosts[server.host].interval, uu._PACE_STEP)
+
+
+    def test_close_with_queued_lookups(self):
+        server = self.servers[0]
+        dispatcher = self.dispatcher(1)
+        futures = [self.submit(dispatcher, server, '/slow/{}'.format(n))
+                   for n in range(4)]
+        _wait_for(lambda: server.arrivals)
+        dispatcher.close()
+        self.assertTrue(all(f.cancelled() for f in futures[1:]))
+        with self.assertRaises(CancelledError):
+            futures[0].result(1)
+        sleep(0.7)
+        self.assertEqual(self.requests_made(), 1)
+
+
+    def test_close_with_waiting_lookup(self):
+        server = self.servers[0]
+        dispatcher = self.dispatcher(2)
+        future = self.submit(dispatcher, server, '/once429/1')
+        _wait_for(lambda: dispatcher._timers)
+        dispatcher.close()
+        with self.assertRaises(CancelledError):
+            future.result(1)
+        sleep(1.2)
+        self.assertEqual(self.requests_made(), 1)
+
+
+    def test_deadline(self):
+        urls = [server.url('/slow/{}'.format(n))
+                for server in self.servers for n in range(6)]
+        start = monotonic()
+        results = uu.updated_urls(urls, concurrency = 4, deadline = 0.3)
+        self.assertLess(monotonic() - start, 0.45)
+        self.assertEqual({r.error for r in results}, {'Time limit reached'})
+        # Only the lookups under way at the deadline reach the servers.
+        sleep(0.8)
+        self.assertEqual(self.requests_made(), 4)
+
+
+    def test_stopping_early(self):
+        urls = [server.url('/slow/{}'.format(n))
+                for server in self.servers for n in range(6)]
+        start = monotonic()
+        results = uu.updated_urls_iter(urls, concurrency = 4)
+        self.assertEqual(next(results).status, 200)
+        results.close()
+        self.assertLess(monotonic() - start, 0.8)
+        sleep(0.8)
+        self.assertLessEqual(self.requests_made(), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,10 +18,25 @@ from .__version__ import __version__, __title__, __description__, __url__
 from .__version__ import __author__, __email__
 from .__version__ import __license__, __copyright__
 
-# Main modules.
-from .urlup import updated_urls, UrlData
-
 # Supporting modules.
 from .messages import msg, color
 from .http_code import code_meaning
 from .errors import ProxyLoginError, ProxyException, NetworkError
+
+# The main modules pull in the network libraries, which take a noticeable
+# time to load.  They're imported the first time one of the following names
+# is accessed, so that importing only this package (as "urlup -V" does) is
+# fast.  This relies on module-level __getattr__, new in Python 3.7.
+_lazy_names = {
+    'updated_urls'      : '.urlup',
+    'updated_urls_iter' : '.urlup',
+    'UrlData'           : '.urlup',
+    'UrlCache'          : '.cache',
+    'clear_cache'       : '.cache',
+}
+
+def __getattr__(name):
+    if name in _lazy_names:
+        from importlib import import_module
+        return getattr(import_module(_lazy_names[name], __name__), name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
@@ -14,28 +14,44 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-import csv
 import os
 import os.path as path
 import plac
-import requests
+import re
+import socket
 import sys
-try:
-    from termcolor import colored
-except ImportError:
-    pass
-from   uritools import urisplit
 
 import urlup
-from urlup import updated_urls
 from urlup.messages import color, msg
 
 
+# Global constants.
+# ......................................................................
+
+_NOT_URL_RE = re.compile(r'^(?://[^/?#]*)?(?:[?#].*)?$')
+'''
+Pattern matching strings that have neither a URL scheme nor a path, and so
+cannot be taken for URLs (e.g., "//host" or "?query").
+'''
+
+_FLUSH_INTERVAL = 1000
+'''
+Number of rows written to the CSV output file between explicit flushes, so
+that partial results are on disk if the program is interrupted.
+'''
+
+_OUTPUT_BUFFER_SIZE = 1 << 20
+'''
+Size in bytes of the buffer used when writing the CSV output file.
+'''
+
+
 # Main program.
 # ......................................................................
 
 @plac.annotations(
     cookies    = ('list of cookie value pairs separated by commas',  'option', 'c'),
+    cache      = ('reuse and save results in cache database file D', 'option', 'd'),
     explain    = ('print explanations of HTTP codes encountered',    'flag',   'e'),
     input      = ('read URLs from file F',                           'option', 'i'),
     output     = ('write results to file R',                         'option', 'o'),
@@ -45,14 +61,15 @@ from urlup.messages import color, msg
     no_color   = ('do not color-code terminal output (default: do)', 'flag',   'C'),
     reset      = ('reset proxy user name and password',              'flag',   'R'),
     version    = ('print version info and exit',                     'flag',   'V'),
+    workers    = ('look up N URLs at a time (default: 8)',           'option', 'w'),
     no_keyring = ('do not use a keyring',                            'flag',   'X'),
     url        = 'URL to dereference (can supply more than one)',
 )
 
-def main(cookies = {}, explain = False,
+def main(cookies = {}, cache = 'D', explain = False,
          input='F', output='R', user = 'U', pswd = 'P',
          quiet=False, no_color=False, reset=False, no_keyring=False,
-         version=False, *url):
+         version=False, workers='N', *url):
     '''Find the ultimate destination for URLs after following redirections.
 
 If the command-line option -i (or /i on Windows) is not provided, this
@@ -91,6 +108,14 @@ again even if an entry already exists in the keyring or keychain.
 
 Currently, the use of only a single EZProxy proxy is supported.
 
+If the option -d (or /d on Windows) is given, Urlup will keep the results
+of lookups in a database file named after the -d option, and in later runs
+that use the same file, it will take results from the file instead of
+contacting the servers again.  Successful results in the file are reused
+for up to 7 days, and errors returned by servers for up to 1 hour.  If -d
+is not given but the environment variable URLUP_CACHE_PATH is set, its
+value is used as the name of the database file.
+
 Connections can be optionally passed session cookie values on the command
 line using the -c (or /c on Windows) argument.  The argument should be
 followed by a list of key=value pairs separated by commas without spaces.
@@ -98,12 +123,16 @@ Example: "acookie=avalue,anothercookie=anothervalue".
 
 This program will print information to the terminal as it processes URLs,
 unless the option -q (or /q on Windows) is given to make it more quiet.
+
+URLs are looked up several at a time, but the results are reported in the
+same order as the URLs were given.  The option -w (or /w on Windows) sets
+the number of lookups done at the same time; the default is 8.
 '''
 
     # Our defaults are to do things like color the output, which means the
     # command line flags make more sense as negated values (e.g., "nocolor").
     # Dealing with negated variables is confusing, so turn them around here.
-    colorize = 'termcolor' in sys.modules and not no_color
+    colorize = not no_color
     use_keyring = not no_keyring
 
     # Some user interactions change depending on the current platform.
@@ -116,16 +145,27 @@ unless the option -q (or /q on Windows) is given to make it more quiet.
         print('URL: {}'.format(urlup.__url__))
         print('License: {}'.format(urlup.__license__))
         sys.exit()
+
+    # The modules needed for network work are slow to load, so they're only
+    # imported once we know we'll need them (i.e., not for -V or -h).
+    import csv
+    from urlup.cache import UrlCache
+    from urlup.urlup import http_session, updated_urls_iter
+
     # We use default values that provide more intuitive help text printed by
     # plac.  Rewrite the values to things we actually use.
     if input == 'F' and not path.exists('F'):
         input = None
     if output == 'R':
         output = None
+    if cache == 'D':
+        cache = os.environ.get('URLUP_CACHE_PATH') or None
     if user == 'U':
         user = None
     if pswd == 'P':
         pswd = None
+    if workers == 'N':
+        workers = 8
     if on_windows:
         get_help = '(Hint: use /h to get help.)'
     else:
@@ -140,6 +180,13 @@ unless the option -q (or /q on Windows) is given to make it more quiet.
         msg("No output file specified; results won't be saved.", 'warn', colorize)
     elif not quiet:
         rename_if_existing(output, colorize)
+    try:
+        workers = int(workers)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        raise SystemExit(color('The value of -w must be a number of at least 1. '
+                               + get_help, 'error', colorize))
     if cookies:
         cookies = dictify_cookie_list(cookies)
 
@@ -149,63 +196,73 @@ unless the option -q (or /q on Windows) is given to make it more quiet.
 
     # Let's do this thing.
     ulist = []
-    results = []
     try:
         if input:
-            file_path = None
-            if path.exists(input):
-                file_path = input
-            elif path.exists(path.join(os.getcwd(), input)):
-                file_path = path.join(os.getcwd(), input)
-            else:
+            file_path = path.abspath(input)
+            if not path.isfile(file_path):
                 raise SystemExit(color('Cannot find file "{}"'.format(input),
                                        'error', colorize))
             if not quiet:
                 msg('Reading URLs from {}'.format(file_path))
-            with open(file_path) as f:
-                ulist = map(str.rstrip, f.readlines())
+            ulist = lines_in_file(file_path)
         else:
             # Not given a file.  Do the arguments look like URLs?
-            parts = urisplit(url[0])
-            if not parts.scheme and not parts.path:
+            if _NOT_URL_RE.match(url[0]):
                 raise SystemExit(color('{} does not appear to be a URL'.format(url[0]),
                                        'error', colorize))
             ulist = url
-        results = updated_urls(ulist, cookies, {}, user, pswd, use_keyring,
-                               reset, quiet, explain, colorize)
-
-        if not results:
-            msg('No results returned.')
-            sys.exit()
-        elif output:
-            if not quiet:
-                msg('Writing CSV file {}'.format(output))
-            with open(output, 'w', newline='') as out:
-                csvwriter = csv.writer(out, delimiter=',')
-                if not isinstance(results, list):
-                    results = [results]
-                for data in results:
-                    if data:
-                        csvwriter.writerow([data.original, data.final or '',
-                                            data.status, data.error or ''])
-        elif quiet:
-            # Rationale for the sense of the test against the "quiet" argument:
-            # If we were being quiet, no other info will be printed.  Conversely,
-            # if we weren't being quiet, then the following would be redundant.
-            msg('Results:')
-            if not isinstance(results, list):
-                results = [results]
-            for item in filter(None, results):
-                if item.error:
-                    msg('Encountered error {} dereferencing {}'
-                        .format(item.error, item.original), 'error', colorize)
-                elif not item.final:
-                    msg('Could not dereference {}'.format(item.original),
-                        'warn', colorize)
+        # Use one session for the whole run so that connections are reused,
+        # and make sure its sockets are released even if we're interrupted.
+        # Results are handled as they arrive, so that output starts right
+        # away.  Only a bounded number of recent results are kept in memory
+        # (for repeated URLs), however long the input is.
+        count = 0
+        url_cache = UrlCache(cache) if cache else None
+        try:
+            with http_session(workers) as session:
+                results = filter(None, updated_urls_iter(ulist, cookies, {}, user, pswd,
+                                                         use_keyring, reset, quiet,
+                                                         explain, colorize,
+                                                         concurrency = workers,
+                                                         session = session,
+                                                         cache = url_cache))
+                if output:
+                    if not quiet:
+                        msg('Writing CSV file {}'.format(output))
+                    with open(output, 'w', newline='', buffering = _OUTPUT_BUFFER_SIZE) as out:
+                        csvwriter = csv.writer(out, delimiter=',')
+                        for data in results:
+                            csvwriter.writerow([data.original, data.final or '',
+                                                data.status, data.error or ''])
+                            count += 1
+                            if count % _FLUSH_INTERVAL == 0:
+                                out.flush()
+                elif quiet:
+                    # Rationale for the sense of the test against the "quiet" argument:
+                    # If we were being quiet, no other info will be printed.  Conversely,
+                    # if we weren't being quiet, then the following would be redundant.
+                    msg('Results:')
+                    for item in results:
+                        count += 1
+                        if item.error:
+                            msg('Encountered error {} dereferencing {}'
+                                .format(item.error, item.original), 'error', colorize)
+                        elif not item.final:
+                            msg('Could not dereference {}'.format(item.original),
+                                'warn', colorize)
+                        else:
+                            msg('{} => {}'.format(color(item.original, 'info', colorize),
+                                                  color(item.final, 'info', colorize)))
+                    msg('Done.')
                 else:
-                    msg('{} => {}'.format(color(item.original, 'info', colorize),
-                                          color(item.final, 'info', colorize)))
-            msg('Done.')
+                    # Each result is printed by updated_urls_iter as it's found.
+                    for item in results:
+                        count += 1
+        finally:
+            if url_cache:
+                url_cache.close()
+        if not count:
+            msg('No results returned.')
     except KeyboardInterrupt:
         msg('Quitting.')
 
@@ -228,27 +285,29 @@ def rename_if_existing(file, colorize):
 
     if path.exists(file):
         rename(file)
-        return
-    full_path = path.join(os.getcwd(), file)
-    if path.exists(full_path):
-        rename(full_path)
-        return
+
+
+def lines_in_file(file_path):
+    '''Yield the lines of the file one at a time, without line endings.  The
+    file stays open only while lines are being read from it.'''
+    with open(file_path) as f:
+        for line in f:
+            yield line.rstrip()
 
 
 def dictify_cookie_list(cookie_list):
-    cookies = {}
-    for pair in cookie_list.split(','):
-        kv = pair.split('=')
-        cookies[kv[0]] = kv[1]
-    return cookies
+    # Split on the first '=' only, because values (e.g., base64 strings) can
+    # contain '='.  A pair without '=' gets an empty value.
+    return dict(pair.partition('=')[::2] for pair in cookie_list.split(','))
 
 
 def network_available():
-    '''Return True if it appears we have a network connection, False if not'''
+    '''Return True if it appears we have a network connection, False if not.
+    The check only opens (and closes) a TCP connection; no data is sent.'''
     try:
-        r = requests.get("https://www.caltech.edu")
+        socket.create_connection(("www.caltech.edu", 443), timeout = 5).close()
         return True
-    except requests.ConnectionError:
+    except OSError:
         return False
 
 
@@ -0,0 +1,129 @@
+'''
+cache: persistent record of URL lookup results
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2018-2021 by the California Institute of Technology.  This code
+is open-source software released under a 3-clause BSD license.  Please see the
+file "LICENSE" for more information.
+'''
+
+import os
+import sqlite3
+from   time import time
+
+
+# Global constants.
+# .............................................................................
+
+_MAX_AGE = 7 * 24 * 60 * 60
+'''
+Default number of seconds for which a cached result is considered valid.
+'''
+
+_ERROR_MAX_AGE = 60 * 60
+'''
+Default number of seconds for which a cached error result (such as a 404
+code) is considered valid.  This is shorter than _MAX_AGE because errors
+are more likely than successes to go away on their own.
+'''
+
+_COMMIT_INTERVAL = 100
+'''
+Number of new results stored between commits to the database file.
+'''
+
+
+# Class definitions.
+# .............................................................................
+
+class UrlCache():
+    '''A record of URL lookup results kept in an SQLite database file, so that
+    later runs can reuse the results instead of going to the network again.
+    A UrlCache can be used as a context manager, in which case it is closed
+    (and any unsaved results are written out) on exit from the context.
+    '''
+
+    def __init__(self, file, max_age = _MAX_AGE, error_max_age = _ERROR_MAX_AGE):
+        '''Open or create the cache database in 'file'.  Results older than
+        'max_age' seconds, and error results older than 'error_max_age'
+        seconds, are ignored by get().
+        '''
+        self._max_age = max_age
+        self._error_max_age = error_max_age
+        self._unsaved = 0
+        self._db = sqlite3.connect(file)
+        self._db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY,'
+                         ' final TEXT, status INTEGER, error TEXT, time REAL)')
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def get(self, url):
+        '''Return a tuple (final URL, status code, error) for 'url', or None if
+        there is no result for 'url' or the result has expired.'''
+        row = self._db.execute('SELECT final, status, error, time FROM urls'
+                               ' WHERE url = ?', (url,)).fetchone()
+        if row and time() - row[3] < (self._error_max_age if row[2] else self._max_age):
+            return row[:3]
+        return None
+
+
+    def put(self, url, final, status, error):
+        '''Store the result of looking up 'url'.'''
+        self._db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)',
+                         (url, final, status, error, time()))
+        self._unsaved += 1
+        if self._unsaved >= _COMMIT_INTERVAL:
+            self._db.commit()
+            self._unsaved = 0
+
+
+    def clear(self):
+        '''Remove all results from the cache.'''
+        self._db.execute('DELETE FROM urls')
+        self._db.commit()
+        self._unsaved = 0
+
+
+    def close(self):
+        '''Write out any unsaved results and close the database file.'''
+        self._db.commit()
+        self._db.close()
+
+
+# Main functions.
+# .............................................................................
+
+def clear_cache(path = None):
+    '''Remove all results from the cache database file 'path'.  If 'path' is
+    None, the file named by the environment variable URLUP_CACHE_PATH (the
+    one the command-line program uses by default) is cleared instead.  It is
+    not an error for the file not to exist yet.
+    '''
+    path = path or os.environ.get('URLUP_CACHE_PATH')
+    if not path:
+        raise ValueError('No cache file given and URLUP_CACHE_PATH is not set')
+    if os.path.exists(path):
+        with UrlCache(path) as cache:
+            cache.clear()
+
+
+# Please leave the following for Emacs users.
+# ......................................................................
+# Local Variables:
+# mode: python
+# python-indent-offset: 4
+# End:
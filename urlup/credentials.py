@@ -15,13 +15,9 @@ file "LICENSE" for more information.
 '''
 
 import getpass
-import keyring
+import json
 import sys
 
-if sys.platform.startswith('win'):
-    import keyring.backends
-    from keyring.backends.Windows import WinVaultKeyring
-
 
 # Credentials/keyring functions
 # .............................................................................
@@ -43,10 +39,9 @@ if sys.platform.startswith('win'):
 #
 #  2. We need to store several pieces of information, not just a password,
 #  but the Python keyring module interface (and presumably most system
-#  keychains) does not allow anything but a string value.  The hackacious
-#  solution taken here is to concatenate several values into a single string
-#  used as the actual value stored.  The individual values are separated by a
-#  character that is unlikely to be part of any user-typed value.
+#  keychains) does not allow anything but a string value.  The solution taken
+#  here is to encode the several values as a single JSON string, and store
+#  that as the actual value.
 
 def get_credentials(service, user=None):
     '''Looks up the user's credentials for the given 'service' using the
@@ -55,9 +50,7 @@ def get_credentials(service, user=None):
     service with a different user login name than the user's current login
     name without having to ask the user for the alternative name every time.
     '''
-    if sys.platform.startswith('win'):
-        keyring.set_keyring(WinVaultKeyring())
-    value = keyring.get_password(service, user if user else 'credentials')
+    value = _keyring().get_password(service, user if user else 'credentials')
     return _decode(value) if value else (None, None, None, None)
 
 
@@ -67,9 +60,7 @@ def save_credentials(service, user, pswd, host=None, port=None):
     pswd = pswd if pswd else ''
     host = host if host else ''
     port = port if port else ''
-    if sys.platform.startswith('win'):
-        keyring.set_keyring(WinVaultKeyring())
-    keyring.set_password(service, 'credentials', _encode(user, pswd, host, port))
+    _keyring().set_password(service, 'credentials', _encode(user, pswd, host, port))
 
 
 def obtain_credentials(service, display_name,
@@ -97,19 +88,34 @@ def obtain_credentials(service, display_name,
     return (user, pswd, host, port)
 
 
-_sep = ''
-'''Character used to separate multiple actual values stored as a single
-encoded value string.  This character is deliberately chosen to be something
-very unlikely to be part of a legitimate string value typed by user at a
-shell prompt, because control-c is normally used to interrupt programs.
+_sep = '\x03'
+'''Character used to separate multiple actual values in the encoded value
+strings written by older versions of this module.  New values are stored as
+JSON, but values in the old form may still be present in users' keyrings.
 '''
 
 def _encode(user, pswd, host, port):
-    return '{}{}{}{}{}{}{}'.format(user, _sep, pswd, _sep, host, _sep, port)
+    return json.dumps({'user': user, 'pswd': pswd, 'host': host, 'port': port})
 
 
 def _decode(value_string):
-    return tuple(value_string.split(_sep))
+    if value_string.startswith('{'):
+        d = json.loads(value_string)
+        return (d['user'], d['pswd'], d['host'], d['port'])
+    # Old format.  Pad in case trailing values were missing.
+    values = value_string.split(_sep, 3)
+    return tuple(values + [''] * (4 - len(values)))
+
+
+def _keyring():
+    '''Return the keyring module, set up for the current platform.  The
+    module is slow to load and only needed if a proxy is used, so it's not
+    imported until it's first needed.'''
+    import keyring
+    if sys.platform.startswith('win'):
+        from keyring.backends.Windows import WinVaultKeyring
+        keyring.set_keyring(WinVaultKeyring())
+    return keyring
 
 
 def getpassword(prompt):
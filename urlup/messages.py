@@ -14,15 +14,25 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from   functools import lru_cache
 import sys
+from   threading import Lock
 
 try:
     from termcolor import colored
     if sys.platform.startswith('win'):
         import colorama
         colorama.init()
+    _HAVE_TERMCOLOR = True
 except ImportError:
-    pass
+    _HAVE_TERMCOLOR = False
+
+
+_ON_WINDOWS = sys.platform.startswith('win')
+'''True if we're running on Windows.'''
+
+_print_lock = Lock()
+'''Lock used to keep lines printed from different threads from interleaving.'''
 
 
 def print_header(text, flags, quiet = False, colorize = True):
@@ -37,17 +47,18 @@ def msg(text, flags = None, colorize = True):
     colorizes the output by default. Flushing immediately is useful when
     piping the output of a script, because Python by default will buffer the
     output in that situation and this makes it very difficult to see what is
-    happening in real time.
+    happening in real time.  If termcolor is not installed, the text is
+    printed without colors.
     '''
-    if colorize:
-        print(color(text, flags), flush = True)
-    else:
+    if colorize and _HAVE_TERMCOLOR:
+        text = color(text, flags)
+    with _print_lock:
         print(text, flush = True)
 
 
 def color(text, flags = None, colorize = True):
     (prefix, color_name, attributes) = color_codes(flags)
-    if colorize:
+    if colorize and _HAVE_TERMCOLOR:
         if attributes and color_name:
             return colored(text, color_name, attrs = attributes)
         elif color_name:
@@ -63,11 +74,18 @@ def color(text, flags = None, colorize = True):
 
 
 def color_codes(flags):
-    color_name  = ''
-    prefix = ''
     if type(flags) is not list:
         flags = [flags]
-    if sys.platform.startswith('win'):
+    return _color_codes(frozenset(flags))
+
+
+@lru_cache(maxsize = 128)
+def _color_codes(flags):
+    # Only a handful of flag combinations are used, so the results are
+    # cached.  The attributes are returned as a tuple so they can be shared.
+    color_name  = ''
+    prefix = ''
+    if _ON_WINDOWS:
         attrib = [] if 'dark' in flags else ['bold']
     else:
         attrib = []
@@ -97,7 +115,7 @@ def color_codes(flags):
         attrib.append('reverse')
     if 'dark' in flags:
         attrib.append('dark')
-    return (prefix, color_name, attrib)
+    return (prefix, color_name, tuple(attrib))
 
 
 # Please leave the following for Emacs users.
@@ -14,18 +14,14 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
+from   collections import OrderedDict
 import getpass
+import re
 import requests
-import sys
+from   threading import RLock
 from   time import time, sleep
+from   urllib.parse import unquote, urlsplit
 
-try:
-    thisdir = os.path.dirname(os.path.abspath(__file__))
-    sys.path.append(os.path.join(thisdir, '../..'))
-except:
-    sys.path.append('../..')
-
-import urlup
 from urlup.credentials import get_credentials, save_credentials, obtain_credentials
 from urlup.errors import NetworkError, ProxyLoginError, ProxyException
 
@@ -37,7 +33,7 @@ if __debug__:
     import logging
     logging.basicConfig(level = logging.INFO)
     logger = logging.getLogger('urlup')
-    def log(s, *other_args): logger.debug('urlup: ' + s.format(*other_args))
+    def log(s, *other_args): logger.debug('urlup: ' + s, *other_args)
 
 
 # Global constants.
@@ -65,6 +61,22 @@ Maximum number of times a network operation is tried before this module stops
 trying and exits with an error.
 '''
 
+_URL_PARAM_RE = re.compile(r'[?&]url=(.+)$')
+'''
+Pattern for the query parameter holding the destination URL in a proxied URL.
+'''
+
+_LOGIN_MAX_AGE = 300
+'''
+Number of seconds for which the cookies from a proxy login are reused before
+logging in again.
+'''
+
+_MAX_PROXY_HOSTS = 16
+'''
+Maximum number of proxy hosts whose login results are kept by a ProxyHelper.
+'''
+
 
 # Class definitions.
 # .............................................................................
@@ -78,7 +90,6 @@ class ProxyHelper():
     _user = None
     _pswd = None
     _reset = False
-    _auth_data = {}
 
     def __init__(self, proxy_user, proxy_pswd, use_keyring = True, reset = False):
         '''Initialize a proxy helper.  Parameters 'proxy_user' and 'proxy_pswd'
@@ -95,8 +106,14 @@ class ProxyHelper():
         self._pswd = proxy_pswd
         self._use_keyring = use_keyring
         self._reset = reset
-        if __debug__: log('Initizlied proxy helper with user {}, password {}'
-                          .format(proxy_user, proxy_pswd))
+        # URLs may be dereferenced in parallel threads, but we only want to
+        # ask the user for credentials and log in to the proxy one at a time.
+        self._lock = RLock()
+        # Successful proxy logins and their times, so that we don't log in
+        # to the same proxy for every URL.
+        self._auth_data = OrderedDict()
+        if __debug__: log('Initizlied proxy helper with user %s, password %s',
+                          proxy_user, proxy_pswd)
 
 
     def authenticate_proxy(self, url):
@@ -112,7 +129,7 @@ class ProxyHelper():
         data for subsequent network calls.
         '''
         proxy_host = self.proxy_host_from_url(url)
-        if __debug__: log('Authenticating to proxy host {}'.format(proxy_host))
+        if __debug__: log('Authenticating to proxy host %s', proxy_host)
         if not self._user or not self._pswd or self._reset:
             if self._use_keyring and not self._reset:
                 if __debug__: log('Getting credentials from keyring')
@@ -145,7 +162,7 @@ class ProxyHelper():
                 auth = requests.post(login, data = data, allow_redirects = False,
                                      timeout = _NETWORK_TIMEOUT)
             except requests.exceptions.Timeout:
-                if __debug__: log('retrying in {}s', sleep_time)
+                if __debug__: log('retrying in %ss', sleep_time)
                 failures += 1
                 sleep(sleep_time)
                 sleep_time *= _SLEEP_FACTOR
@@ -163,50 +180,67 @@ class ProxyHelper():
             raise ProxyException('Unable to connect to {}'.format(proxy_host))
 
         # Successfully connected to the proxy server. Process the results.
-        if __debug__: log('Proxy response code {}'.format(auth.status_code))
+        if __debug__: log('Proxy response code %s', auth.status_code)
         if len(auth.cookies) == 0:
             # No cookies => authentication unsuccessful.
             raise ProxyLoginError('Login incorrect')
         if 200 <= auth.status_code <= 400:
             # Anything in the 200-399 range seems to work out okay.
-            self._auth_data[proxy_host] = auth
+            self._auth_data[proxy_host] = (auth, time())
+            self._auth_data.move_to_end(proxy_host)
+            if len(self._auth_data) > _MAX_PROXY_HOSTS:
+                self._auth_data.popitem(last = False)
         else:
             # Something went wrong.
             raise ProxyException('Unable to authenticate to proxy: {}')
 
 
     def cookies(self, url):
-        '''Return a Python Requests library Cookie object.'''
+        '''Return a Python Requests library Cookie object.  The user is
+        logged in to the proxy the first time a URL for it is seen; later
+        calls reuse the cookies from that login for up to 5 minutes.  Each
+        call returns a copy of them, which the caller is free to change.'''
         if not self.url_contains_proxy(url):
             return {}
-        self.authenticate_proxy(url)
-        proxy_host = self.proxy_host_from_url(url)
-        if proxy_host in self._auth_data:
-            return self._auth_data[proxy_host].cookies
-        else:
-            return {}
+        with self._lock:
+            proxy_host = self.proxy_host_from_url(url)
+            _, when = self._auth_data.get(proxy_host, (None, 0))
+            if time() - when >= _LOGIN_MAX_AGE:
+                self.authenticate_proxy(url)
+            if proxy_host in self._auth_data:
+                self._auth_data.move_to_end(proxy_host)
+                return self._auth_data[proxy_host][0].cookies.copy()
+            else:
+                return {}
 
 
     def proxy_host_from_url(self, url):
         '''Extract and return the proxy host part from a URL.'''
         # We expect to see a URL of the form
         #   https://clsproxy.library.caltech.edu/....stuff....
-        # We return the first address.
-        # Note: 8 is the length of 'https://', which will will work even if we get http
-        next_slash = url.find('/', 8)
-        return url[:next_slash]
+        # We return the scheme and host part, e.g.,
+        #   https://clsproxy.library.caltech.edu
+        parts = urlsplit(url)
+        return parts.scheme + '://' + parts.netloc
 
 
     def proxied_url(self, url):
-        '''Return the destination URL buried inside a proxied URL.'''
+        '''Return the destination URL buried inside a proxied URL, or None
+        if there isn't one.'''
         # FIXME this is too specific to ezproxy
-        start = url.find('url=')
-        return url[start + 4:]
+        match = _URL_PARAM_RE.search(url)
+        if not match:
+            return None
+        destination = match.group(1)
+        # The destination may or may not have been %-encoded.
+        return destination if '://' in destination else unquote(destination)
 
 
     def url_contains_proxy(self, url):
         '''Returns True if the given URL appears to include a proxy part.'''
-        return 'proxy' in url
+        # Only the host name counts; "proxy" can turn up anywhere in a path
+        # or query string (e.g., "https://example.com/reverse-proxy-guide").
+        return 'proxy' in (urlsplit(url).hostname or '')
 
 
 # Please leave the following for Emacs users.
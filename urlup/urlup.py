@@ -19,31 +19,32 @@ is open-source software released under a 3-clause BSD license.  Please see the
 file "LICENSE" for more information.
 '''
 
-from   collections import Iterable, namedtuple
+from   collections import Counter, OrderedDict, deque, namedtuple
+from   concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from   concurrent.futures import TimeoutError as FutureTimeoutError
+from   contextlib import contextmanager
+from   datetime import datetime, timezone
+from   email.utils import parsedate_to_datetime
+from   functools import lru_cache
+from   heapq import heappop, heappush
 import http.client
-from   http.client import responses as http_responses
-from   itertools import tee
-import os
+from   http.cookiejar import DefaultCookiePolicy
+from   itertools import count
+from   random import uniform
+import re
 import requests
+from   requests.adapters import HTTPAdapter
 import socket
 import sys
 import textwrap
-from   time import time, sleep
-from   urllib.parse import urlsplit, quote_plus
-from   urllib.request import urlopen, Request
+from   threading import Condition, Lock, Thread
+from   time import monotonic
+from   urllib.parse import urlsplit
 import urllib3.exceptions
-import validators
+from   urllib3.util.ssl_ import create_urllib3_context
 
-try:
-    thisdir = os.path.dirname(os.path.abspath(__file__))
-    sys.path.append(os.path.join(thisdir, '../..'))
-except:
-    sys.path.append('../..')
-
-import urlup
 from urlup.messages import color, msg
 from urlup.http_code import code_meaning
-from urlup.credentials import get_credentials, save_credentials, obtain_credentials
 from urlup.errors import NetworkError, ProxyLoginError, ProxyException
 from urlup.proxy_helper import ProxyHelper
 
@@ -55,7 +56,7 @@ if __debug__:
     import logging
     logging.basicConfig(level = logging.INFO)
     logger = logging.getLogger('urlup')
-    def log(s, *other_args): logger.debug('urlup: ' + s.format(*other_args))
+    def log(s, *other_args): logger.debug('urlup: ' + s, *other_args)
 
 
 # Global constants.
@@ -69,7 +70,19 @@ How long to wait on a network connection attempt.
 _SLEEP_FACTOR = 2
 '''
 Each time a failure occurs, this module will wait a while and try again.  The
-wait duration increases geometrically by this factor each time.
+longest wait increases geometrically by this factor each time, starting at
+_SLEEP_BASE and up to _SLEEP_MAX; the actual wait is a random fraction of it,
+so that lookups that failed together don't all retry at the same moment.
+'''
+
+_SLEEP_BASE = 0.25
+'''
+Longest time in seconds to wait before the first retry of a failed lookup.
+'''
+
+_SLEEP_MAX = 8
+'''
+Longest time in seconds to wait before any retry of a failed lookup.
 '''
 
 _MAX_RETRIES = 3
@@ -78,6 +91,167 @@ Maximum number of times a network operation is tried before this module stops
 trying and exits with an error.
 '''
 
+_HEAD_REJECTED_CODES = (403, 405, 501)
+'''
+HTTP status codes with which some servers answer HEAD requests even though
+they would answer GET requests for the same URL normally.
+'''
+
+_POOL_SIZE = 32
+'''
+Least number of hosts for which keep-alive connections are pooled, and the
+number of connections kept per host.  More hosts are pooled if more URLs are
+to be dereferenced in parallel.
+'''
+
+_DEFAULT_CONCURRENCY = 8
+'''
+Default number of URLs that are dereferenced in parallel when given a list.
+'''
+
+_MAX_PER_HOST = 6
+'''
+Maximum number of lookups done at the same time on any one host.  (This is
+the usual per-host connection limit in web browsers.)
+'''
+
+_MAX_HOST_FAILURES = 3
+'''
+Number of times a host may fail to answer (by timing out or having a name
+that can't be resolved) before the remaining URLs on that host are reported
+as failing the same way without trying them.
+'''
+
+_PACE_STEP = 0.25
+'''
+Number of seconds by which the spacing between requests to a host shrinks
+after each successful lookup on it.  (The spacing doubles, starting from
+this value, each time the host asks us to slow down.)
+'''
+
+_MAX_PACE = 60
+'''
+Maximum number of seconds between the starts of lookups on the same host.
+'''
+
+_UNREACHABLE_ERRORS = ('Timed out trying to connect', 'Cannot resolve host name')
+'''
+Errors that indicate a host can't be reached at all.
+'''
+
+_TRANSIENT_ERRORS = (requests.exceptions.ConnectionError,
+                     requests.exceptions.Timeout,
+                     requests.exceptions.ChunkedEncodingError)
+'''
+Exceptions from network operations that may not happen if the operation is
+tried again.  Lookups that fail with other exceptions are not retried.
+'''
+
+_MAX_RETRY_AFTER = 30
+'''
+Longest time in seconds that we'll wait when a server returns code 429 or 503
+and asks us to try again later.  If it asks for longer, we don't wait.
+'''
+
+_TRY_LATER_CODES = (429, 503)
+'''
+HTTP codes with which a server says that the client should try again later.
+'''
+
+_CODE_ERRORS = {
+    **dict.fromkeys((401, 402, 403, 407, 451, 511),
+                    'Access is forbidden or requires authentication'),
+    **dict.fromkeys((404, 410), 'No content found at this location'),
+    **dict.fromkeys((405, 406, 409, 411, 412, 414, 417, 428, 431, 505, 510),
+                    'Server returned code {} -- please report this'),
+    **dict.fromkeys((415, 416), 'Server rejected the request'),
+    429: 'Server blocking further requests due to rate limits',
+    503: 'Server is unavailable -- try again later',
+    **dict.fromkeys((500, 501, 502, 506, 507, 508), 'Internal server error'),
+}
+'''
+Error messages for HTTP codes that mean a URL could not be dereferenced.
+A "{}" in a message is replaced by the code.  Codes not listed here get
+the message "Unable to resolve URL".
+'''
+
+_HTTP_SCHEMES = ('http', 'https')
+'''
+URL schemes that can be dereferenced.
+'''
+
+_SEVERITY = ('info', 'info', 'info', 'cyan', 'error')
+'''
+Message color for HTTP codes, indexed by the first digit of the code.  Codes
+of 400 and up use the last entry.
+'''
+
+_URL_CACHE_SIZE = 10000
+'''
+Number of distinct URLs for which the results of normalized_url() are kept.
+'''
+
+_HOST_CACHE_SIZE = 1000
+'''
+Number of distinct host names for which the results of checking that they
+are valid domain names are kept.
+'''
+
+_DOMAIN_RE = re.compile(r'(?=.{1,253}$)(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+'
+                        r'[a-z0-9][a-z0-9-]{0,61}[a-z]', re.IGNORECASE)
+'''
+Pattern matching plain ASCII domain names.  It accepts a subset of what
+validators.domain() accepts, so that anything it doesn't match (such as an
+internationalized name) can be left to validators.domain() to decide.
+'''
+
+_DNS_MAX_AGE = 300
+'''
+Number of seconds for which a host name lookup is reused during a batch of
+URL lookups.  Long runs resolve a host again after this, in case its
+addresses have changed.
+'''
+
+_MAX_PENDING = 1000
+'''
+Maximum number of URLs from a list that are read and queued for lookup ahead
+of the result currently awaited by the caller.
+'''
+
+_MAX_REMEMBERED = 10000
+'''
+Number of distinct URLs from a list whose results are kept for handing out
+again if the URL is repeated.  The least recently seen URLs are forgotten
+first, except for those still waiting to be handed out.  (This must be
+larger than _MAX_PENDING.)
+'''
+
+_MAX_ACCEPTED_RETRIES = 5
+'''
+How many more times to try a URL for which the server returned code 202
+(Accepted) before giving up and reporting the code as is.
+'''
+
+_MAX_REDIRECTS = 20
+'''
+Maximum number of redirections followed for a single URL.  (The default in
+requests is 30, which is more than any legitimate chain needs.)
+'''
+
+_MAX_VISITS = 2
+'''
+Number of times a chain of redirections may pass through the same URL.  Some
+sites redirect a URL to itself once (e.g., after setting a cookie), but a
+chain that comes back to a URL more often than this is taken to be a loop.
+'''
+
+_MAX_DRAIN_SIZE = 64 * 1024
+'''
+Largest body (in bytes) that is read and discarded after a GET, so that the
+connection can be kept open and reused.  Longer bodies are not worth the
+download, so their connections are closed instead.
+'''
+
 _DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:75.0) Gecko/20100101 Firefox/75.0'
 '''
 Fake agent header for interacting with EZProxy over the network.
@@ -102,100 +276,294 @@ UrlData.__doc__ = '''Data about the eventual destination of a given URL.
 def updated_urls(urls, cookies = {}, headers = {},
                  proxy_user = None, proxy_pswd = None,
                  use_keyring = True, reset = False,
-                 quiet = True, explain = False, colorize = False):
+                 quiet = True, explain = False, colorize = False,
+                 concurrency = _DEFAULT_CONCURRENCY, session = None,
+                 cache = None, deadline = None):
     '''Update one URL or a list of URLs.  If given a single URL, it returns a
     single tuple of the following form:
        (old URL, new URL, http status code, error)
     If given a list of URLs, it returns a list of tuples of the same form.
+    The URLs in a list are dereferenced in parallel using up to 'concurrency'
+    threads; the results are returned in the same order as the input.  URLs
+    that occur more than once in the list are only dereferenced once.
+    Network connections are made using the requests Session object given
+    as 'session', so that connections to the same host are kept alive and
+    reused; if 'session' is None, a session shared by all calls is used.
+    If 'cache' is a UrlCache object, results found in it are used instead of
+    going to the network, and new results are added to it.  Only results for
+    which a server returned a status code are added, except for codes that
+    ask the client to try again later.  If 'deadline' is a number of seconds,
+    URLs whose lookups have not finished that long after the start are given
+    the error 'Time limit reached' instead of being waited for.  Lookups that
+    have not started by then are dropped; those under way are left to finish
+    in the background, and their results are discarded.
+    '''
+    single = isinstance(urls, str)
+    results = updated_urls_iter([urls] if single else urls,
+                                cookies, headers, proxy_user, proxy_pswd,
+                                use_keyring, reset, quiet, explain, colorize,
+                                concurrency, session, cache, deadline)
+    return next(results) if single else list(results)
+
+
+def updated_urls_iter(urls, cookies = {}, headers = {},
+                      proxy_user = None, proxy_pswd = None,
+                      use_keyring = True, reset = False,
+                      quiet = True, explain = False, colorize = False,
+                      concurrency = _DEFAULT_CONCURRENCY, session = None,
+                      cache = None, deadline = None):
+    '''Update an iterable of URLs, yielding one result at a time.  This takes
+    the same arguments as updated_urls() and yields the same tuples, in the
+    same order as the input, but each result is yielded as soon as it is
+    available instead of after all of the URLs have been dereferenced.
     '''
     helper = ProxyHelper(proxy_user, proxy_pswd, use_keyring, reset)
-    if isinstance(urls, (list, tuple, Iterable)) and not isinstance(urls, str):
-        return [_url_data(url, cookies, headers, helper, quiet, explain, colorize)
-                for url in urls]
-    else:
-        return _url_data(urls, cookies, headers, helper, quiet, explain, colorize)
+    session = session or _SESSION
+    def attempt(job, unreachable):
+        if unreachable:
+            # The host has failed to answer too often to keep trying it.
+            data = UrlData(job.url, None, None, unreachable)
+            if not quiet:
+                _print_result(data, explain, colorize)
+            return data, None
+        return _attempt(job, cookies, headers, helper, session,
+                        quiet, explain, colorize)
+
+    # Look up each distinct URL once, and hand out that result for repeats.
+    # The normalized form of each URL serves as the key, and is passed to the
+    # lookup so that it doesn't have to parse the URL again.  Only the most
+    # recently seen URLs are remembered, so that memory use doesn't grow with
+    # the length of the list; 'waiting' counts the entries in 'pending' for
+    # each key, and keys with any are never forgotten.
+    lookups = OrderedDict()
+    waiting = Counter()
+    uncached = set()
+    # Lookups run in the worker threads while the caller consumes results
+    # in this one.  The queue of pending lookups is bounded so that input
+    # is only read as fast as results are used.
+    pending = deque()
+    end = None if deadline is None else monotonic() + deadline
+    def time_left():
+        return None if end is None else max(0, end - monotonic())
+    def out_of_time(url):
+        return UrlData(url, None, None, 'Time limit reached')
+    def finished(limit):
+        while len(pending) > limit:
+            url, key, future = pending.popleft()
+            waiting[key] -= 1
+            if not waiting[key]:
+                del waiting[key]
+            try:
+                result = future.result(time_left())
+            except (FutureTimeoutError, CancelledError):
+                # Time is up for every lookup that hasn't finished, so end
+                # them all (see _Dispatcher.close()).
+                dispatcher.close()
+                result = out_of_time(url)
+                if not quiet:
+                    _print_result(result, explain, colorize)
+            if key in uncached:
+                uncached.remove(key)
+                if cache and result and _cacheable(result):
+                    cache.put(key, result.final, result.status, result.error)
+            yield result._replace(original = url) if result else result
+
+    executor = ThreadPoolExecutor(max_workers = concurrency)
+    dispatcher = _Dispatcher(executor, attempt)
+    with _dns_caching():
+        try:
+            for url in urls:
+                url = url.strip()
+                starting_url = normalized_url(url)
+                key = starting_url or url
+                if key in lookups:
+                    lookups.move_to_end(key)
+                else:
+                    lookups[key] = _cached_result(cache, url, starting_url,
+                                                  quiet, explain, colorize)
+                    if not lookups[key]:
+                        parts = urlsplit(starting_url) if starting_url else None
+                        if parts and parts.scheme not in _HTTP_SCHEMES:
+                            # No need to involve the network to find this out.
+                            data = UrlData(url, None, None, 'Unsupported network protocol')
+                            lookups[key] = _completed(data, quiet, explain, colorize)
+                        elif time_left() == 0:
+                            lookups[key] = _completed(out_of_time(url), quiet,
+                                                      explain, colorize)
+                        else:
+                            host = parts.netloc if parts else ''
+                            lookups[key] = dispatcher.submit(url, starting_url, host)
+                            uncached.add(key)
+                pending.append((url, key, lookups[key]))
+                waiting[key] += 1
+                while len(lookups) > _MAX_REMEMBERED:
+                    oldest = next(iter(lookups))
+                    if oldest in waiting:
+                        lookups.move_to_end(oldest)
+                    else:
+                        del lookups[oldest]
+                yield from finished(_MAX_PENDING)
+            yield from finished(0)
+        finally:
+            # If we're stopped early, drop the lookups nobody will see, and
+            # don't wait for the attempts still under way.
+            dispatcher.close()
+            if sys.version_info >= (3, 9):
+                executor.shutdown(wait = False, cancel_futures = True)
+            else:
+                executor.shutdown(wait = False)
+
 
+def _cacheable(data):
+    '''Return True if 'data' is a result that may be stored in a cache.'''
+    return data.status is not None and data.status not in _TRY_LATER_CODES
 
-def _url_data(url, cookies, headers, proxy_helper, quiet, explain, colorize):
-    '''Update one URL and return a tuple of (old URL, new URL).'''
-    url = url.strip()
+
+def _cached_result(cache, url, starting_url, quiet, explain, colorize):
+    '''Return a completed Future holding the result for 'url' from 'cache', or
+    None if 'cache' is None or has no result for 'url'.'''
+    found = cache.get(starting_url) if cache and starting_url else None
+    if not found:
+        return None
+    return _completed(UrlData(url, *found), quiet, explain, colorize)
+
+
+def _completed(data, quiet, explain, colorize):
+    '''Return a completed Future holding 'data', after printing it (unless
+    'quiet' is True) the way the result of a lookup is printed.'''
+    if not quiet:
+        _print_result(data, explain, colorize)
+    future = Future()
+    future.set_result(data)
+    return future
+
+
+def _attempt(job, cookies, headers, proxy_helper, session,
+             quiet, explain, colorize):
+    '''Make one attempt at looking up the URL of 'job' (a _Lookup object).
+    Returns a tuple (data, delay): either 'data' is the final UrlData and
+    'delay' is None, or 'data' is None and 'delay' is the number of seconds
+    to wait before making the next attempt.  The waiting is left to the
+    caller, so that no thread has to be tied up meanwhile.'''
+    url = job.url
     if not url:
-        return ()
-    retry = True
-    failures = 0
-    sleep_time = 2
-    while retry and failures < _MAX_RETRIES:
-        retry = False
-        error = None
-        try:
-            (old, new, code, error) = _analysis(url, cookies, headers, proxy_helper)
-            if not quiet:
-                if error:
-                    msg('{} -- {}'.format(url, color(error, 'error', colorize)))
-                elif explain:
-                    desc = code_meaning(code)
-                    details = '[status code {} = {}]'.format(code, desc)
-                    text = textwrap.fill(details, initial_indent = '   ',
-                                         subsequent_indent = '   ')
-                    msg('{} ==> {}\n{}'.format(color(old, severity(code), colorize),
-                                               color(new, severity(code), colorize),
-                                               color(text, 'dark', colorize)))
-                else:
-                    msg('{} ==> {} {}'.format(color(old, severity(code), colorize),
-                                              color(new, severity(code), colorize),
-                                              color('[' + str(code) + ']', 'dark', colorize)))
-            return UrlData(old, new, code, error)
-        except requests.exceptions.ConnectTimeout as err:
-            if not quiet:
-                msg('{} connection timed out'.format(url), 'error', colorize)
-            return UrlData(url, None, None, 'Timed out trying to connect')
-        except Exception as err:
-            # If we fail, try again in case it's actually due to a network issue
-            if __debug__: log('{}: {}', url, err)
-            failures += 1
+        return (), None
+    job.code = None
+    try:
+        if job.rechecks is None:
+            result, delay = _analysis_once(url, job.starting_url, cookies,
+                                           headers, proxy_helper, session)
+            job.code = result[2]
+            # With codes 429 and 503, servers can say how long to wait before
+            # trying again.  Do that if it's not too long.
+            if delay is not None and delay <= _MAX_RETRY_AFTER and job.waits < _MAX_RETRIES - 1:
+                if __debug__: log('Waiting %ss as asked by server for %s', delay, url)
+                job.waits += 1
+                return None, delay
+            if job.code == 202:
+                # Code 202 = Accepted, "received but not yet acted upon."  Wait
+                # a short time and try again, a limited number of times.
+                if __debug__: log('Pausing & retrying')
+                job.rechecks = 0
+                return None, 1
+            data = UrlData(*result)
+        else:
+            result, _ = _analysis_once(job.starting_url, job.starting_url, cookies,
+                                       headers, proxy_helper, session)
+            job.rechecks += 1
+            if result[2] == 202 and job.rechecks < _MAX_ACCEPTED_RETRIES:
+                return None, 1
+            # Report the original response code, not the subsequent one.
+            data = UrlData(url, result[1], 202, None)
+    except requests.exceptions.ConnectTimeout as err:
+        if not quiet:
+            msg(f'{url} connection timed out', 'error', colorize)
+        return UrlData(url, None, None, 'Timed out trying to connect'), None
+    except requests.exceptions.TooManyRedirects as err:
+        error = 'Too many redirections'
+    except requests.exceptions.SSLError as err:
+        error = 'Unable to make a secure connection'
+    except _TRANSIENT_ERRORS as err:
+        # If we fail, try again in case it's actually due to a network issue
+        if __debug__: log('%s: %s', url, err)
+        job.failures += 1
+        if not quiet:
+            msg(f'{url} connection attempt failed: {err}', 'warn', colorize)
+        if job.failures < _MAX_RETRIES:
+            limit = min(_SLEEP_MAX, _SLEEP_BASE * _SLEEP_FACTOR ** (job.failures - 1))
+            delay = uniform(0, limit)
             if not quiet:
-                msg('{} connection attempt failed: {}'.format(url, err), 'warn', colorize)
-                msg('Retrying in {}s ...'.format(sleep_time), 'warn', colorize)
-            sleep(sleep_time)
-            sleep_time *= _SLEEP_FACTOR
-            retry = True
-    if failures >= _MAX_RETRIES:
+                msg(f'Retrying in {delay:.2f}s ...', 'warn', colorize)
+            return None, delay
+        error = 'Connection failed'
+    except Exception as err:
+        # Anything else won't be fixed by trying again.
+        if __debug__: log('%s: %s', url, err)
+        error = f'Unexpected error: {err}'
+    else:
         if not quiet:
-            if error:
-                msg('{}: {}'.format(url, color(error, 'error', colorize)))
-            else:
-                msg('{}: {}'.format(url, color('Failed', 'error', colorize)))
-        return UrlData(url, None, None, error)
-    return UrlData(url, None, None, None)
+            _print_result(data, explain, colorize)
+        return data, None
+    data = UrlData(url, None, None, error)
+    if not quiet:
+        _print_result(data, explain, colorize)
+    return data, None
+
+
+def _print_result(data, explain, colorize):
+    (old, new, code, error) = data
+    if error:
+        msg(f'{old} -- {color(error, "error", colorize)}')
+        return
+    level = severity(code)
+    old = color(old, level, colorize)
+    new = color(new, level, colorize)
+    if explain:
+        msg(f'{old} ==> {new}\n{color(_explanation(code), "dark", colorize)}')
+    else:
+        msg(f'{old} ==> {new} {color(f"[{code}]", "dark", colorize)}')
 
 
-def _analysis(url, cookies, headers, proxy_helper):
-    if __debug__: log('Looking up {}'.format(url))
-    starting_url = normalized_url(url)
+@lru_cache()
+def _explanation(code):
+    '''Return the text printed for HTTP 'code' when explanations are asked
+    for.  Only a few different codes turn up in practice, so the wrapped text
+    is computed once for each.'''
+    try:
+        meaning = code_meaning(code)
+    except ValueError:
+        meaning = 'Unrecognized code.'
+    return textwrap.fill(f'[status code {code} = {meaning}]',
+                         initial_indent = '   ', subsequent_indent = '   ')
+
+
+def _analysis_once(url, starting_url, cookies, headers, proxy_helper, session):
+    '''Look up 'url' once.  Returns a tuple of (result, delay), where 'delay'
+    is the number of seconds the server asked us to wait before trying again,
+    or None if it didn't ask.'''
+    if __debug__: log('Looking up %s', url)
     if not starting_url:
-        return (url, None, None, 'Malformed URL')
+        return (url, None, None, 'Malformed URL'), None
 
     # Connect to the host.
     cookie_jar = None
     using_proxy = False
     try:
         if proxy_helper.url_contains_proxy(starting_url):
-            if __debug__: log('URL uses a proxy: {}'.format(starting_url))
+            if __debug__: log('URL uses a proxy: %s', starting_url)
             using_proxy = True
             cookie_jar = proxy_helper.cookies(starting_url)
             requests.utils.add_dict_to_cookiejar(cookie_jar, cookies)
-            if 'User-Agent' not in headers:
-                headers['User-Agent'] = _DEFAULT_USER_AGENT
-            conn = requests.get(starting_url, cookies = cookie_jar,
-                                headers = headers, timeout = _NETWORK_TIMEOUT)
+            # Don't modify the caller's dict; it's shared by parallel lookups.
+            headers = dict({'User-Agent': _DEFAULT_USER_AGENT}, **headers)
+            conn = _response(session, starting_url, cookie_jar, headers)
             code = conn.status_code
             ending_url = conn.url
         else:
             if __debug__: log('URL has no proxy -- going straight to it')
             cookie_jar = requests.cookies.RequestsCookieJar()
             requests.utils.add_dict_to_cookiejar(cookie_jar, cookies)
-            conn = requests.get(starting_url, cookies = cookie_jar,
-                                headers = headers, timeout = _NETWORK_TIMEOUT)
+            conn = _response(session, starting_url, cookie_jar, headers)
             if conn.history:
                 # Redirection occured.  Get the first status code.
                 code = conn.history[0].status_code
@@ -211,94 +579,427 @@ def _analysis(url, cookies, headers, proxy_helper):
                     msg = 'Proxy is unable to resolve the destination host name'
                 else:
                     msg = 'Cannot resolve host name'
-                return (starting_url, None, None, msg)
-            else:
-                raise
+                return (starting_url, None, None, msg), None
+        # Anything else (e.g., a kept-alive connection that was reset) is
+        # left for _attempt() to retry.
+        raise
     except requests.exceptions.InvalidSchema as err:
-        return (starting_url, None, None, "Unsupported network protocol")
+        return (starting_url, None, None, "Unsupported network protocol"), None
     except http.client.InvalidURL as err:
         # Docs for HTTPResponse say this is raised if port info is bad.
-        if __debug__: log('Bad port in {}: {}'.format(starting_url, str(err)))
-        return (starting_url, None, None, "Bad port")
+        if __debug__: log('Bad port in %s: %s', starting_url, err)
+        return (starting_url, None, None, "Bad port"), None
     except (ProxyLoginError, ProxyException, NetworkError) as err:
-        if __debug__: log('Proxy error: {}'.format(starting_url, str(err)))
-        return (starting_url, None, None, "Proxy login failure")
+        if __debug__: log('Proxy error for %s: %s', starting_url, err)
+        return (starting_url, None, None, "Proxy login failure"), None
     except Exception as err:
-        if __debug__: log('Error accessing {}: {}'.format(starting_url, str(err)))
+        if __debug__: log('Error accessing %s: %s', starting_url, err)
         raise
 
     # Interpret the response.
-    if __debug__: log('Got response code {} for {}'.format(code, starting_url))
-    if code == 202:
-        # Code 202 = Accepted, "received but not yet acted upon."
-        if __debug__: log('Pausing & retrying')
-        sleep(1)                        # Sleep a short time and try again.
-        final_data = _analysis(starting_url, cookies, headers, proxy_helper)
-        # Return the original response code, not the subsequent one.
-        return (url, final_data[1], code, None)
-    elif 200 <= code < 400:
-        return (url, ending_url, code, None)
-    elif code in [401, 402, 403, 407, 451, 511]:
-        return (url, None, code, "Access is forbidden or requires authentication")
-    elif code in [404, 410]:
-        return (url, None, code, "No content found at this location")
-    elif code in [405, 406, 409, 411, 412, 414, 417, 428, 431, 505, 510]:
-        return (url, None, code, "Server returned code {} -- please report this".format(code))
-    elif code in [415, 416]:
-        return (url, None, code, "Server rejected the request")
-    elif code == 429:
-        return (url, None, code, "Server blocking further requests due to rate limits")
-    elif code == 503:
-        return (url, None, code, "Server is unavailable -- try again later")
-    elif code in [500, 501, 502, 506, 507, 508]:
-        return (url, None, code, "Internal server error")
-    else:
-        return (url, None, code, "Unable to resolve URL")
+    if __debug__: log('Got response code %s for %s', code, starting_url)
+    if 200 <= code < 400:
+        return (url, ending_url, code, None), None
+    error = _CODE_ERRORS.get(code, 'Unable to resolve URL').format(code)
+    if code in _TRY_LATER_CODES:
+        return (url, None, code, error), retry_after(conn.headers.get('Retry-After'))
+    return (url, None, code, error), None
 
 
+def _response(session, url, cookies, headers):
+    '''Request 'url' and follow redirections, without downloading the content.
+    This uses HEAD, falling back to GET for servers that reject HEAD.'''
+    conn = session.head(url, cookies = cookies, headers = headers,
+                        allow_redirects = True, timeout = _NETWORK_TIMEOUT,
+                        hooks = {'response': _loop_breaker()})
+    if conn.status_code in _HEAD_REJECTED_CODES:
+        if __debug__: log('HEAD rejected by %s -- using GET', url)
+        # Don't download a long body; closing the response discards it.
+        conn = session.get(url, cookies = cookies, headers = headers,
+                           stream = True, timeout = _NETWORK_TIMEOUT,
+                           hooks = {'response': _loop_breaker()})
+        length = conn.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) <= _MAX_DRAIN_SIZE:
+            # Reading a short body lets the connection go back to the pool.
+            conn.content
+        conn.close()
+    return conn
+
+
+def _loop_breaker():
+    '''Return a requests response hook that stops a chain of redirections as
+    soon as it has come back to the same URL more than _MAX_VISITS times,
+    rather than letting it go on until _MAX_REDIRECTS is reached.'''
+    visits = Counter()
+    def check(response, *args, **kwargs):
+        if response.is_redirect:
+            visits[response.url] += 1
+            if visits[response.url] > _MAX_VISITS:
+                if __debug__: log('Redirection loop at %s', response.url)
+                response.close()
+                raise requests.exceptions.TooManyRedirects(
+                    'Redirection loop at {}'.format(response.url), response = response)
+    return check
+
+
+# Lookup scheduling.
+# .............................................................................
+
+class _Lookup():
+    '''The state of the lookup of one URL, which can take several attempts.'''
+
+    def __init__(self, url, starting_url, host):
+        self.url = url
+        self.starting_url = starting_url
+        self.host = host
+        self.future = Future()          # Where the UrlData result goes.
+        self.code = None                # HTTP code from the latest attempt.
+        self.started = 0                # When the latest attempt started.
+        self.failures = 0               # Attempts failed by transient errors.
+        self.waits = 0                  # Times the server asked us to wait.
+        self.rechecks = None            # Attempts after a 202 code, if any.
+
+
+class _Host():
+    '''Bookkeeping for the lookups on one host.'''
+
+    def __init__(self):
+        self.running = 0                # Attempts in progress.
+        self.ready = deque()            # Lookups waiting for a free slot.
+        self.interval = 0               # Spacing between starts of attempts.
+        self.next_start = 0             # Earliest time for the next start.
+        self.slowed = 0                 # When the spacing last grew.
+        self.wakeup = False             # Whether a start is scheduled.
+        self.failures = 0               # Times the host couldn't be reached.
+        self.error = None               # Why it couldn't be reached.
+
+
+class _Dispatcher():
+    '''Runs lookups on the worker threads of a ThreadPoolExecutor.  At most
+    _MAX_PER_HOST attempts are in progress on any one host at a time, and
+    attempts on hosts that have asked us to slow down are spaced out: the
+    spacing doubles each time a host does (counting only answers to attempts
+    started since it last grew, so that a burst of refusals to requests that
+    were already under way counts once), and shrinks a step at a time again
+    as its lookups succeed.  A lookup that has to wait before its next
+    attempt is set aside on a timer instead of keeping a worker busy, so
+    that waiting on one host never holds up lookups on the others.
+
+    The Future of a lookup stays pending until its first attempt starts, so
+    until then it can be cancelled.  close() ends all unfinished lookups:
+    those that haven't started are cancelled, and the Futures of those that
+    have get a CancelledError.  An attempt already under way can't be
+    stopped, but its result is thrown away.
+    '''
+
+    def __init__(self, executor, attempt):
+        '''Use the workers of 'executor' to call 'attempt', a function that
+        takes a _Lookup and the error with which its host has repeatedly
+        failed to answer (or None), and returns a tuple like _attempt().'''
+        self._executor = executor
+        self._attempt = attempt
+        self._hosts = {}
+        self._jobs = set()              # Lookups without a result yet.
+        self._timers = []               # Heap of (time, number, _Host, _Lookup).
+        self._numbers = count()
+        self._lock = Lock()
+        self._wakeup = Condition(self._lock)
+        self._closed = False
+        Thread(target = self._run_timers, daemon = True).start()
+
+
+    def submit(self, url, starting_url, host):
+        '''Start looking up 'url' on 'host', and return a Future for the
+        resulting UrlData.'''
+        job = _Lookup(url, starting_url, host)
+        with self._lock:
+            if self._closed:
+                job.future.cancel()
+                return job.future
+            self._jobs.add(job)
+            state = self._hosts.setdefault(host, _Host())
+            state.ready.append(job)
+            self._start(state)
+        return job.future
+
+
+    def close(self):
+        '''Start no more attempts, and end every lookup that doesn't have a
+        result yet, including those waiting to try again.'''
+        with self._lock:
+            self._closed = True
+            jobs, self._jobs = self._jobs, set()
+            for state in self._hosts.values():
+                state.ready.clear()
+            self._timers.clear()
+            self._wakeup.notify()
+        for job in jobs:
+            if not job.future.cancel():
+                job.future.set_exception(CancelledError())
+
+
+    def _start(self, state):
+        '''Hand ready lookups on host 'state' to the workers, as far as its
+        slots and spacing allow.  Must be called with the lock held.'''
+        while state.ready and state.running < _MAX_PER_HOST and not self._closed:
+            now = monotonic()
+            if state.interval:
+                if now < state.next_start:
+                    if not state.wakeup:
+                        state.wakeup = True
+                        self._later(state.next_start, state, None)
+                    return
+                state.next_start = now + state.interval
+            job = state.ready.popleft()
+            if job.future.cancelled():
+                self._jobs.discard(job)
+                continue
+            job.started = now
+            state.running += 1
+            self._executor.submit(self._run, job, state)
+
+
+    def _later(self, when, state, job):
+        '''Schedule 'job' to be made ready again at time 'when', or if 'job'
+        is None, another try at starting lookups on host 'state'.  Must be
+        called with the lock held.'''
+        heappush(self._timers, (when, next(self._numbers), state, job))
+        self._wakeup.notify()
+
+
+    def _run(self, job, state):
+        '''Make one attempt at 'job'.  This runs on a worker thread.'''
+        with self._lock:
+            skip = self._closed or job not in self._jobs
+            if not skip and not job.future.running():
+                # First attempt.  From here on, only close() can end it.
+                skip = not job.future.set_running_or_notify_cancel()
+            if skip:
+                self._jobs.discard(job)
+                state.running -= 1
+                self._start(state)
+                return
+        unreachable = state.error if state.failures >= _MAX_HOST_FAILURES else None
+        data, delay, error = None, None, None
+        try:
+            data, delay = self._attempt(job, unreachable)
+        except Exception as err:
+            error = err
+        with self._lock:
+            state.running -= 1
+            if job not in self._jobs:
+                # close() has already ended this lookup.
+                return
+            if data and data.error in _UNREACHABLE_ERRORS:
+                state.failures += 1
+                state.error = data.error
+            if job.code in _TRY_LATER_CODES:
+                if job.started >= state.slowed:
+                    state.interval = min(_MAX_PACE, max(_PACE_STEP, state.interval * 2))
+                    state.slowed = monotonic()
+                state.next_start = max(state.next_start, monotonic() + state.interval)
+            elif state.interval:
+                state.interval = max(0, state.interval - _PACE_STEP)
+            if delay is not None and not error:
+                self._later(monotonic() + delay, state, job)
+            else:
+                self._jobs.discard(job)
+            self._start(state)
+        if error:
+            job.future.set_exception(error)
+        elif delay is None:
+            job.future.set_result(data)
+
+
+    def _run_timers(self):
+        '''Make lookups ready again as their waits end.  This runs on a
+        thread of its own until close() is called.'''
+        with self._lock:
+            while not self._closed:
+                if not self._timers:
+                    self._wakeup.wait()
+                    continue
+                wait = self._timers[0][0] - monotonic()
+                if wait > 0:
+                    self._wakeup.wait(wait)
+                    continue
+                _, _, state, job = heappop(self._timers)
+                if job:
+                    # Waiting lookups go ahead of ones that haven't started.
+                    state.ready.appendleft(job)
+                else:
+                    state.wakeup = False
+                self._start(state)
+
+
 # Misc. utilities
 # .............................................................................
 
-def http_connection(parts):
-    if parts.scheme == 'https':
-        return http.client.HTTPSConnection(parts.netloc, timeout=_NETWORK_TIMEOUT)
-    else:
-        return http.client.HTTPConnection(parts.netloc, timeout=_NETWORK_TIMEOUT)
+class _SharedContextAdapter(HTTPAdapter):
+    '''HTTPAdapter whose verified HTTPS connections share one SSL context per
+    CA certificate bundle.  Left to itself, urllib3 reads and parses the
+    whole bundle again for every new connection.'''
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if conn.cert_reqs == 'CERT_REQUIRED' and (conn.ca_certs or conn.ca_cert_dir):
+            conn.conn_kw['ssl_context'] = _ssl_context(conn.ca_certs, conn.ca_cert_dir)
+            conn.ca_certs = conn.ca_cert_dir = None
+        else:
+            conn.conn_kw.pop('ssl_context', None)
+
+
+@lru_cache()
+def _ssl_context(ca_certs, ca_cert_dir):
+    '''Return an SSL context that verifies servers against the certificates
+    in file 'ca_certs' or directory 'ca_cert_dir', creating it the first time
+    it's asked for.'''
+    context = create_urllib3_context()
+    context.load_verify_locations(ca_certs, ca_cert_dir)
+    return context
+
+
+def http_session(concurrency = _DEFAULT_CONCURRENCY):
+    '''Return a new requests Session object configured to keep a pool of
+    keep-alive connections.  The pool is made large enough for 'concurrency'
+    lookups to be done in parallel without dropping each other's hosts.'''
+    # Retries are left to _attempt(), which knows which errors are worth
+    # retrying; urllib3 would also retry (and log) failed host name lookups.
+    hosts = max(_POOL_SIZE, concurrency)
+    adapter = _SharedContextAdapter(pool_connections = hosts, pool_maxsize = _POOL_SIZE)
+    session = requests.Session()
+    session.max_redirects = _MAX_REDIRECTS
+    # Cookies that servers set are still sent on the redirections of the
+    # lookup that got them (requests keeps a jar for each request), but the
+    # session itself accepts none, so that no lookup sees another's cookies
+    # and results don't depend on the order in which URLs are looked up.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains = []))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_SESSION = http_session()
+'''
+Session used for network connections when the caller does not supply one.
+'''
+
+
+_real_getaddrinfo = socket.getaddrinfo
+_dns_cache = {}
+_dns_users = 0
+_dns_lock = Lock()
+
+
+def _cached_getaddrinfo(host, port, *args, **kwargs):
+    '''Replacement for socket.getaddrinfo() that remembers its results for
+    up to _DNS_MAX_AGE seconds.'''
+    key = (host, port, args, tuple(sorted(kwargs.items())))
+    found, when = _dns_cache.get(key, (None, 0))
+    if found is None or monotonic() - when > _DNS_MAX_AGE:
+        found = _real_getaddrinfo(host, port, *args, **kwargs)
+        _dns_cache[key] = (found, monotonic())
+    return found
+
+
+@contextmanager
+def _dns_caching():
+    '''Context manager within which each host name is resolved only once
+    (or once every _DNS_MAX_AGE seconds, in a long batch).  Nested and
+    concurrent uses are counted, and the cache is dropped when the last one
+    exits.'''
+    global _dns_users
+    with _dns_lock:
+        _dns_users += 1
+        socket.getaddrinfo = _cached_getaddrinfo
+    try:
+        yield
+    finally:
+        with _dns_lock:
+            _dns_users -= 1
+            if not _dns_users:
+                socket.getaddrinfo = _real_getaddrinfo
+                _dns_cache.clear()
 
 
+@lru_cache(maxsize = _URL_CACHE_SIZE)
 def normalized_url(url):
-    # Returns two values: a SplitResult value (from urllib) and a Boolean
+    '''Return a normalized form of 'url' (with a scheme added if it lacks one,
+    and put in the form returned by canonical_url()), or None if 'url' is
+    malformed.  Results for the most recently seen URLs are remembered, so
+    that repeated URLs are only parsed and validated once.'''
     parts = urlsplit(url)
     if parts.netloc:
-        if validators.domain(host_from_netloc(parts.netloc)):
-            return url
+        if _valid_domain(host_from_netloc(parts.netloc)):
+            return canonical_url(url, parts)
         else:
             return None
     elif not parts.scheme and not parts.path:
         return None
     elif parts.path and not parts.scheme:
-        # Most likely case is the user typed a host or domain name only
-        starting_url = 'http://' + parts.path
-        if __debug__: log('Rewrote {} to {}'.format(url, starting_url))
-        parts = urlsplit(starting_url)
-        if parts.netloc and validators.domain(host_from_netloc(parts.netloc)):
-            return starting_url
+        # Most likely case is the user typed a host or domain name only.
+        # The host is the start of the path, so there's no need to parse
+        # the URL again with a scheme in front.
+        netloc, slash, path = parts.path.partition('/')
+        parts = parts._replace(scheme = 'http', netloc = netloc, path = slash + path)
+        if __debug__: log('Rewrote %s to %s', url, parts.geturl())
+        if netloc and _valid_domain(host_from_netloc(netloc)):
+            return canonical_url(parts.geturl(), parts)
         else:
             return None
-    return url
+    return canonical_url(url, parts)
+
+
+@lru_cache(maxsize = _HOST_CACHE_SIZE)
+def _valid_domain(host):
+    '''Return True if 'host' is a valid domain name.  Lists of URLs tend to
+    have many URLs on a few hosts, so the answers are remembered.'''
+    if _DOMAIN_RE.fullmatch(host):
+        return True
+    # validators is slow to load and only needed for unusual names, so it
+    # isn't imported until one turns up.
+    import validators
+    return bool(validators.domain(host))
+
+
+def canonical_url(url, parts = None):
+    '''Return a form of 'url' in which the parts that are not case-sensitive
+    (the scheme and the host) are lower-cased, so that trivially different
+    spellings of the same URL compare equal.  If the caller already has the
+    result of urlsplit(url), it can be passed as 'parts' to avoid parsing
+    the URL again.'''
+    parts = parts or urlsplit(url)
+    scheme = parts.scheme.lower()
+    # Leave the netloc alone if it contains a user name & password.
+    netloc = parts.netloc if '@' in parts.netloc else parts.netloc.lower()
+    if scheme == parts.scheme and netloc == parts.netloc:
+        return url
+    return parts._replace(scheme = scheme, netloc = netloc).geturl()
 
 
 def host_from_netloc(nl):
-    return nl[:nl.find(':')] if ':' in nl else nl
+    return nl.partition(':')[0]
+
+
+def retry_after(value):
+    '''Return the number of seconds given by the value of a Retry-After HTTP
+    header, which may be a number of seconds or a date, or None if 'value'
+    is None or can't be understood.'''
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        return None
+    return max(0, (when - datetime.now(timezone.utc)).total_seconds())
 
 
 def severity(code):
-    if code < 300:
-        return 'info'
-    elif code < 400:
-        return 'cyan'
-    else:
-        return 'error'
+    return _SEVERITY[min(code // 100, 4)]
 
 
 # Please leave the following for Emacs users.